@@ -1,102 +1,273 @@
-from fastapi import FastAPI, HTTPException, Query, status
-from datetime import datetime, timedelta, timezone
-from typing import Dict
-from jose import jwt
-import base64
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives import serialization
-import uuid
-
-app = FastAPI()
-
-keys: Dict[str, Dict] = {}  # Store RSA keys with their metadata
+from fastapi import FastAPI, HTTPException, Query, Response, status
+from typing import Deque, Dict, List, Literal, Optional, Tuple
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
+import asyncio
+try:
+    import pybase64 as base64  # SIMD-accelerated drop-in replacement for the stdlib module
+except ImportError:
+    import base64
+import heapq
+import logging
+import multiprocessing
+import orjson
+from cryptography.hazmat.primitives.asymmetric import ed25519, padding
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.backends.openssl import backend
+import os
+import secrets
+import time
+import warnings
+from rsa_keygen import generate_rsa_der
+
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Runs the background key generator for the lifetime of the app."""
+    task = asyncio.create_task(_keygen_worker())
+    yield
+    task.cancel()
+    with suppress(asyncio.CancelledError):
+        await task  # Lets the worker shut down its process pool
+
+app = FastAPI(lifespan=lifespan)
+
+keys: Dict[str, Dict] = {}  # Store RSA and Ed25519 keys with their metadata
 KEY_EXPIRY_HOURS = 1  # Key expiry time set to 1 hour
+_jwks_cache: Optional[bytes] = None  # Serialized JWKS document, rebuilt only when the key set changes
+_expiry_heap: List[Tuple[float, str]] = []  # (expiry timestamp, kid) min-heap for expiring keys in order
+_current_kids: Dict[str, Optional[str]] = {}  # Newest active kid per algorithm, used for signing
+_key_pool: Deque[Tuple[str, Dict]] = deque()  # Pre-generated keys waiting to be rotated in
+KEY_POOL_SIZE = 2  # Number of spare keys the background worker keeps ready
+KEY_POOL_POLL_SECONDS = 1  # How often the worker checks whether the pool needs refilling
+KEYGEN_PROCESSES = 2  # Processes used to run RSA prime searches in parallel
+_sign_pool = ThreadPoolExecutor(max_workers=os.cpu_count())  # OpenSSL releases the GIL, so signing scales across cores
 
-def generate_rsa_key():
-    """Generates RSA keys for JWT signing with a unique key ID and expiry."""
-    private_key = rsa.generate_private_key(
-        public_exponent=65537,
-        key_size=2048  # Generates a 2048-bit RSA private key
-    )
+IA32CAP_BMI2_ADX = 0x100 | 0x80000  # BMI2 and ADX bits in the second OPENSSL_ia32cap word
+
+def check_crypto_backend():
+    """Warn at startup if OPENSSL_ia32cap disables the BMI2/ADX bignum kernels used for RSA signing."""
+    version_text = backend.openssl_version_text()
+    # The second word overrides (or with "~", masks) the extended CPUID features OpenSSL detects
+    words = os.environ.get("OPENSSL_ia32cap", "").split(":")
+    extended = words[1] if len(words) > 1 else ""
+    try:
+        if extended.startswith("~"):
+            disabled = int(extended[1:], 16) & IA32CAP_BMI2_ADX
+        else:
+            disabled = extended and IA32CAP_BMI2_ADX & ~int(extended, 16)
+    except ValueError:
+        disabled = 0  # OpenSSL ignores values it cannot parse, so nothing is disabled
+    if disabled:
+        warnings.warn("OPENSSL_ia32cap disables BMI2/ADX; RSA signing will skip the MULX/ADCX kernels", RuntimeWarning)
+    return version_text
+
+def _b64url(data):
+    """Encodes bytes as unpadded URL-safe base64, as used in JWTs and JWKs."""
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+def _build_rsa_key(private_der):
+    """Builds an RSA key and its cached metadata from DER bytes without publishing it."""
+    private_key = serialization.load_der_private_key(private_der, password=None)  # Loaded once, then cached
     public_key = private_key.public_key()  # Derives the public key from the private key
-    kid = str(uuid.uuid4())  # Generates a unique key identifier
-    expiry = datetime.now(timezone.utc) + timedelta(hours=KEY_EXPIRY_HOURS)  # Sets key expiry time
-
-    # Serializes private and public keys to PEM format
-    private_pem = private_key.private_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PrivateFormat.PKCS8,
-        encryption_algorithm=serialization.NoEncryption()  # No encryption for simplicity
-    )
-    public_pem = public_key.public_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    kid = secrets.token_urlsafe(16)  # Generates a unique 128-bit key identifier
+
+    # Converts RSA modulus to a URL-safe base64 string once, cached for the JWK below
+    public_numbers = public_key.public_numbers()
+    n_bytes = public_numbers.n.to_bytes(public_key.key_size // 8, "big")  # 256 bytes for RSA-2048
+
+    return kid, {
+        "alg": "RS256",
+        "private_key_obj": private_key,  # Cached key object, so no PEM is ever serialized or parsed
+        # Public JWK is fixed per key, so it is built once here instead of on every JWKS request
+        "jwk": {
+            "kty": "RSA",
+            "kid": kid,
+            "alg": "RS256",
+            "use": "sig",
+            "n": _b64url(n_bytes).decode(),
+            "e": "AQAB"
+        },
+        # JWT header is fixed per key, so the encoded "header." prefix is built once here instead of on every token
+        "signing_prefix": _b64url(b'{"alg":"RS256","typ":"JWT","kid":"' + kid.encode() + b'"}') + b"."
+    }
+
+def _build_ed25519_key():
+    """Builds an Ed25519 key and its cached metadata without publishing it."""
+    private_key = ed25519.Ed25519PrivateKey.generate()  # Microseconds, unlike RSA prime search
+    kid = secrets.token_urlsafe(16)  # Generates a unique 128-bit key identifier
+    x = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw
     )
 
-    # Stores keys with their ID, and expiry in the global dictionary
-    keys[kid] = {
-        "private": private_pem.decode(),
-        "public": public_pem.decode(),
-        "expiry": expiry
+    return kid, {
+        "alg": "EdDSA",
+        "private_key_obj": private_key,
+        "jwk": {
+            "kty": "OKP",
+            "crv": "Ed25519",
+            "kid": kid,
+            "alg": "EdDSA",
+            "use": "sig",
+            "x": _b64url(x).decode()
+        },
+        "signing_prefix": _b64url(b'{"alg":"EdDSA","typ":"JWT","kid":"' + kid.encode() + b'"}') + b"."
     }
+
+def _publish_key(kid, key_info):
+    """Starts the key's expiry clock and makes it available for signing and JWKS."""
+    global _jwks_cache
+    expiry = time.time() + KEY_EXPIRY_HOURS * 3600  # Sets key expiry as a UNIX timestamp
+    key_info["expiry"] = expiry
+
+    # Stores keys with their ID, and expiry in the global dictionary
+    keys[kid] = key_info
+    heapq.heappush(_expiry_heap, (expiry, kid))  # Tracks the key for expiry
+    _current_kids[key_info["alg"]] = kid  # Newest key becomes the signing key for its algorithm
+    _jwks_cache = None  # Invalidates the serialized JWKS since a key was added
     return kid  # Returns the unique identifier for the generated key
 
+def generate_rsa_key():
+    """Generates RSA keys for JWT signing with a unique key ID and expiry."""
+    return _publish_key(*_build_rsa_key(generate_rsa_der()))
+
+def generate_ed25519_key():
+    """Generates Ed25519 keys for EdDSA JWT signing with a unique key ID and expiry."""
+    return _publish_key(*_build_ed25519_key())
+
+def _new_keygen_pool():
+    """Creates the keygen process pool; spawn avoids forking a process with live threads."""
+    return ProcessPoolExecutor(max_workers=KEYGEN_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+
+async def _keygen_worker():
+    """Keeps the spare key pool filled so requests never block on RSA keygen."""
+    loop = asyncio.get_running_loop()
+    keygen_pool = _new_keygen_pool()
+    try:
+        while True:
+            missing = KEY_POOL_SIZE - len(_key_pool)
+            if missing <= 0:
+                await asyncio.sleep(KEY_POOL_POLL_SECONDS)
+                continue
+            try:
+                # Runs the expensive prime searches in parallel across processes, off the event loop
+                ders = await asyncio.gather(*(loop.run_in_executor(keygen_pool, generate_rsa_der) for _ in range(missing)))
+                for der in ders:
+                    _key_pool.append(await loop.run_in_executor(None, _build_rsa_key, der))
+            except Exception:
+                # Replaces the pool (e.g. after BrokenProcessPool) so refilling keeps going
+                logger.exception("Background RSA keygen failed; restarting the keygen process pool")
+                keygen_pool.shutdown(wait=False, cancel_futures=True)
+                keygen_pool = _new_keygen_pool()
+                await asyncio.sleep(KEY_POOL_POLL_SECONDS)
+    finally:
+        keygen_pool.shutdown(wait=False, cancel_futures=True)
+
 def get_jwks():
     """Retrieve non-expired JWKs for JWT validation."""
     clean_up_expired_keys()  # Removes expired keys before generating JWKS
-    jwks_keys = []
-    for kid, key_info in keys.items():
-        public_key = serialization.load_pem_public_key(key_info["public"].encode())
-        public_numbers = public_key.public_numbers()
-        # Converts RSA modulus to a URL-safe base64 string
-        n_bytes = public_numbers.n.to_bytes((public_numbers.n.bit_length() + 7) // 8, "big")
-
-        jwks_keys.append({
-            "kty": "RSA",
-            "kid": kid,
-            "alg": "RS256",
-            "use": "sig",
-            "n": base64.urlsafe_b64encode(n_bytes).rstrip(b"=").decode(),
-            "e": "AQAB"
-        })
+    return {"keys": _jwks_keys()}
+
+def _jwks_keys():
+    """Builds the public JWK list from the stored keys, without sweeping expired ones."""
+    # Uses the public JWKs cached at key generation time
+    return [key_info["jwk"] for key_info in keys.values()]
 
-    return {"keys": jwks_keys}
+def get_jwks_bytes():
+    """Retrieve the serialized JWKS document, building it only when the key set changed."""
+    global _jwks_cache
+    clean_up_expired_keys()  # May invalidate the cache if any key expired
+    if _jwks_cache is None:
+        _jwks_cache = orjson.dumps({"keys": _jwks_keys()})  # Already swept above
+    return _jwks_cache
+
+def _fall_back_to_newest_kid(alg):
+    """Points the current kid for an algorithm at its newest remaining key, if any."""
+    _current_kids[alg] = next((k for k in reversed(keys) if keys[k]["alg"] == alg), None)
+    return _current_kids[alg]
 
 def clean_up_expired_keys():
     """Remove expired keys from the storage."""
-    current_time = datetime.now(timezone.utc)
-    expired_keys = [kid for kid, key_info in keys.items() if key_info["expiry"] <= current_time]
-    for kid in expired_keys:
-        del keys[kid]  # Deletes the key from the dictionary if it is expired
+    global _jwks_cache
+    current_ts = time.time()  # Single timestamp shared by the whole sweep
+    removed = False
+    # Pops keys in expiry order and stops at the first one that is still valid
+    while _expiry_heap and _expiry_heap[0][0] <= current_ts:
+        _, kid = heapq.heappop(_expiry_heap)
+        key_info = keys.pop(kid, None)  # Deletes the key if it is still stored
+        if key_info is None:
+            continue
+        removed = True
+        alg = key_info["alg"]
+        if _current_kids.get(alg) == kid:
+            _fall_back_to_newest_kid(alg)  # Falls back to the newest remaining key of the same algorithm
+    if removed:
+        _jwks_cache = None  # Invalidates the serialized JWKS once for the whole batch
 
 @app.get("/.well-known/jwks.json")
-def jwks():
+async def jwks():
     """Endpoint to get JSON Web Keys."""
-    return get_jwks()  # Returns the current set of JWKS
+    # Runs on the event loop like auth, so key state is only ever mutated from one thread
+    # Returns the pre-serialized JWKS bytes, skipping per-request JSON encoding
+    return Response(content=get_jwks_bytes(), media_type="application/json")
+
+def _sign_token(key_info, expiry):
+    """Builds and signs a compact RS256 or EdDSA JWS for the given key and expiry."""
+    # Assembles the compact JWS directly since only the expiry varies in the payload
+    payload_b64 = _b64url(b'{"sub":"fake_user","exp":' + str(int(expiry)).encode() + b'}')
+    signing_input = key_info["signing_prefix"] + payload_b64
+    if key_info["alg"] == "EdDSA":
+        signature = key_info["private_key_obj"].sign(signing_input)
+    else:
+        signature = key_info["private_key_obj"].sign(signing_input, padding.PKCS1v15(), hashes.SHA256())
+    return signing_input + b"." + _b64url(signature)
 
 @app.post("/auth")
-def auth(expired: bool = Query(False)):
-    """Generate JWT with optional expired setting for testing."""
+async def auth(
+    expired: bool = Query(False),
+    alg: Literal["RS256", "EdDSA"] = Query("RS256"),
+    raw: bool = Query(False)
+):
+    """Generate JWT with optional expired setting for testing, a choice of RS256 or EdDSA, and optional raw output."""
     clean_up_expired_keys()  # Removes expired keys first
-    
-    if not keys:
-        # Raises HTTP 500 if no keys are available for signing the JWT
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="No keys available")
 
-    key_id = next(iter(keys.keys()))  # Selects the first key available
+    key_id = _current_kids.get(alg)  # Selects the tracked signing key for the algorithm
+
+    if key_id not in keys:
+        # Current kid was removed outside the sweep, so other keys of the same algorithm may remain
+        key_id = _fall_back_to_newest_kid(alg)
+
+    if key_id is None:
+        if alg == "EdDSA":
+            key_id = generate_ed25519_key()  # Ed25519 keygen is cheap enough to run inline
+        elif _key_pool:
+            key_id = _publish_key(*_key_pool.popleft())  # Rotates in a pre-generated key instead of blocking on keygen
+        else:
+            # Raises HTTP 500 if no keys are available for signing the JWT
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="No keys available")
+
     key_info = keys[key_id]
 
     # Adjusts the expiry for testing purposes if 'expired' query param is True
-    expiry = key_info["expiry"] if not expired else datetime.now(timezone.utc) - timedelta(hours=1)
+    expiry = key_info["expiry"] if not expired else time.time() - 3600
 
-    token = jwt.encode(
-        {"sub": "fake_user", "exp": expiry.timestamp()},
-        key_info["private"],
-        algorithm="RS256",
-        headers={"kid": key_id}
-    )
-    
-    return {"token": token}
+    if alg == "EdDSA":
+        token = _sign_token(key_info, expiry)  # Ed25519 signs faster than a hop to the thread pool
+    else:
+        # Signs on the thread pool so the CPU-bound RSA signature never blocks the event loop
+        token = await asyncio.get_running_loop().run_in_executor(_sign_pool, _sign_token, key_info, expiry)
+
+    if raw:
+        return Response(content=token, media_type="application/jwt")  # Bare compact JWS, no JSON framing
+    # Token is base64url and dots only, so it can be framed as JSON without an encoder
+    return Response(content=b'{"token":"' + token + b'"}', media_type="application/json")
+
+# Checks the crypto backend once at import so slow deployments are flagged early
+check_crypto_backend()
 
-# Generates initial key to ensure at least one key is available on startup
+# Generates initial keys to ensure at least one key per algorithm is available on startup
 generate_rsa_key()
+generate_ed25519_key()
@@ -0,0 +1,16 @@
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import serialization
+
+# Kept free of import-time side effects: keygen worker processes import this module, not the server
+
+def generate_rsa_der():
+    """Generates an RSA private key as DER bytes so it can be returned from a worker process."""
+    private_key = rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=2048  # Generates a 2048-bit RSA private key
+    )
+    return private_key.private_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
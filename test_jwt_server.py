@@ -1,8 +1,17 @@
 import pytest
+import warnings
 from fastapi.testclient import TestClient
-from datetime import datetime, timezone, timedelta
+import time
+import asyncio
+import base64
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
 from jose import jwt
-from jwt_server import app, generate_rsa_key, keys, clean_up_expired_keys
+from cryptography.hazmat.backends.openssl import backend
+import jwt_server
+from rsa_keygen import generate_rsa_der
+from jwt_server import app, generate_rsa_key, keys, clean_up_expired_keys, check_crypto_backend, get_jwks_bytes
 
 client = TestClient(app)
 
@@ -41,7 +50,7 @@ def test_auth_expired():
     # Decodes the token using the public key
     decoded = jwt.decode(token, public_key_pem, algorithms=["RS256"], options={"verify_exp": True})
     # Check if the token is indeed expired
-    assert decoded["exp"] < datetime.now(timezone.utc).timestamp()
+    assert decoded["exp"] < time.time()
 
 # Tests function to ensure proper handling of invalid HTTP methods
 def test_invalid_http_methods():
@@ -56,9 +65,114 @@ def test_no_keys_error():
     assert response.json()["detail"] == "No keys available"  # Error message should be specific
 
 # Tests to ensure expired keys are not included in JWKS response
-def test_expired_key_not_in_jwks():
+def test_expired_key_not_in_jwks(monkeypatch):
+    monkeypatch.setattr(jwt_server, "KEY_EXPIRY_HOURS", -1)  # Generate keys that are already expired
     kid = generate_rsa_key()  # Generate a new key
-    keys[kid]['expiry'] = datetime.now(timezone.utc) - timedelta(hours=1)  # Set the key to be expired
     clean_up_expired_keys()  # Clean up the expired keys
-    jwks_response = client.get("/jwks").json()  # Get the JWKS after cleanup
+    assert kid not in keys  # Expired key was removed from storage
+    jwks_response = client.get("/.well-known/jwks.json").json()  # Get the JWKS after cleanup
     assert kid not in [key["kid"] for key in jwks_response["keys"]]  # Verify the expired key is not listed
+
+# Tests function to verify the crypto backend check flags masked CPU features
+def test_check_crypto_backend(monkeypatch):
+    monkeypatch.setenv("OPENSSL_ia32cap", ":~0x80100")  # Mask BMI2 and ADX
+    with pytest.warns(RuntimeWarning):
+        assert check_crypto_backend() == backend.openssl_version_text()
+
+# Tests function to verify extra OPENSSL_ia32cap words do not hide a BMI2/ADX mask
+def test_check_crypto_backend_extra_words(monkeypatch):
+    monkeypatch.setenv("OPENSSL_ia32cap", ":~0x80100:~0x0")  # Third word present
+    with pytest.warns(RuntimeWarning):
+        check_crypto_backend()
+
+# Tests function to verify masking CPU features unrelated to bignum code does not warn
+def test_check_crypto_backend_unrelated_mask(monkeypatch):
+    monkeypatch.setenv("OPENSSL_ia32cap", "~0x200000200000000:~0x20")  # Mask AES-NI/AVX and AVX2 only
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        check_crypto_backend()
+
+# Tests function to verify the cached JWKS document is rebuilt when a key is added
+def test_jwks_cache_invalidated_on_new_key():
+    before = get_jwks_bytes()  # Build and cache the serialized JWKS
+    kid = generate_rsa_key()  # Adding a key must invalidate the cache
+    after = get_jwks_bytes()
+    assert kid.encode() not in before  # New key was not in the old document
+    assert kid.encode() in after  # New key is served after invalidation
+
+# Tests function to verify /auth rotates in a pre-generated key when none are active
+def test_auth_uses_pooled_key():
+    keys.clear()  # Simulate every active key having expired
+    kid, key_info = jwt_server._build_rsa_key(generate_rsa_der())
+    jwt_server._key_pool.append((kid, key_info))  # Stage a spare key as the background worker would
+    response = client.post("/auth")
+    assert response.status_code == 200  # Token issued without generating a key on the request path
+    assert kid in keys  # Pooled key was published
+
+# Tests function to verify hand-assembled tokens validate against the published JWKS
+def test_auth_token_verifies_with_jwks():
+    token = client.post("/auth").json()["token"]  # Issue a valid token
+    kid = jwt.get_unverified_header(token)["kid"]  # Find the signing key ID
+    jwk = next(key for key in client.get("/.well-known/jwks.json").json()["keys"] if key["kid"] == kid)
+    decoded = jwt.decode(token, jwk, algorithms=["RS256"])  # Verify signature with the public JWK
+    assert decoded["sub"] == "fake_user"
+
+# Tests function to verify EdDSA tokens validate against the published Ed25519 JWK
+def test_auth_eddsa():
+    response = client.post("/auth?alg=EdDSA")  # Request an Ed25519-signed token
+    assert response.status_code == 200
+    token = response.json()["token"]
+    assert jwt.get_unverified_header(token)["alg"] == "EdDSA"
+    kid = jwt.get_unverified_header(token)["kid"]
+    jwk = next(key for key in client.get("/.well-known/jwks.json").json()["keys"] if key["kid"] == kid)
+    assert jwk["kty"] == "OKP" and jwk["crv"] == "Ed25519"
+    public_key = Ed25519PublicKey.from_public_bytes(base64.urlsafe_b64decode(jwk["x"] + "=="))
+    signing_input, signature = token.rsplit(".", 1)
+    public_key.verify(base64.urlsafe_b64decode(signature + "=="), signing_input.encode())  # Raises if invalid
+
+# Tests function to verify the raw flag returns the bare compact JWS
+def test_auth_raw():
+    response = client.post("/auth?raw=true")  # Request the token without JSON framing
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/jwt"
+    assert response.text.count(".") == 2  # header.payload.signature
+
+# Tests function to verify the background keygen worker recovers after a failed refill
+def test_keygen_worker_recovers(monkeypatch):
+    calls = []
+    def flaky_generate_rsa_der():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("simulated worker crash")  # First refill attempt fails
+        return generate_rsa_der()
+    monkeypatch.setattr(jwt_server, "generate_rsa_der", flaky_generate_rsa_der)
+    monkeypatch.setattr(jwt_server, "_new_keygen_pool", lambda: ThreadPoolExecutor(max_workers=1))
+    monkeypatch.setattr(jwt_server, "KEY_POOL_POLL_SECONDS", 0)
+    monkeypatch.setattr(jwt_server, "_key_pool", deque())  # Restored after the test so pooled keys don't leak
+
+    async def run_until_filled():
+        task = asyncio.create_task(jwt_server._keygen_worker())
+        while len(jwt_server._key_pool) < jwt_server.KEY_POOL_SIZE:
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(asyncio.wait_for(run_until_filled(), timeout=30))
+    assert len(jwt_server._key_pool) == jwt_server.KEY_POOL_SIZE  # Refilled despite the failure
+
+# Tests function to verify /auth signs with the newest key and falls back when it expires
+def test_auth_tracks_current_key(monkeypatch):
+    older = generate_rsa_key()  # Still valid after the newer key expires
+    monkeypatch.setattr(jwt_server, "KEY_EXPIRY_HOURS", -1)
+    newer = generate_rsa_key()  # Newest key, but already expired
+    assert jwt_server._current_kids["RS256"] == newer
+    token = client.post("/auth").json()["token"]  # Cleanup drops the expired current key
+    assert jwt.get_unverified_header(token)["kid"] == older
+
+# Tests function to verify /auth falls back to another key when the current kid is deleted directly
+def test_auth_falls_back_when_current_key_deleted():
+    older = generate_rsa_key()  # Remains available for signing
+    newer = generate_rsa_key()  # Becomes the current signing key
+    del keys[newer]  # Remove the current key without going through the expiry sweep
+    response = client.post("/auth")
+    assert response.status_code == 200  # Signs with the remaining key instead of failing
+    assert jwt.get_unverified_header(response.json()["token"])["kid"] == older